@@ -1,10 +1,17 @@
 import os
+import asyncio
+import functools
+from concurrent.futures import ThreadPoolExecutor
+import httpx
+import aiosqlite
 from dotenv import load_dotenv
 from typing import TypedDict, Annotated, List
 from langchain_openai import ChatOpenAI
-from langchain_core.messages import BaseMessage, ToolMessage, HumanMessage
-from langgraph.prebuilt import ToolNode
+from langchain_core.messages import BaseMessage, ToolMessage, HumanMessage, trim_messages
+from langchain_core.messages.utils import count_tokens_approximately
+from langchain_core.utils.function_calling import convert_to_openai_tool
 from langgraph.graph import StateGraph, END
+from langgraph.checkpoint.sqlite.aio import AsyncSqliteSaver
 
 # All tools imported from the updated tools.py file
 from .tools import (
@@ -46,26 +53,88 @@ tools = [
     get_event_schedule,
     send_email
 ]
-tool_executor = ToolNode(tools)
+# Tools are plain functions, so dispatch straight to them by name
+TOOLS_BY_NAME = {t.__name__: t for t in tools}
+# Tools that only return constants are cheap enough to run on the event loop
+NON_BLOCKING_TOOLS = {"get_cafeteria_timings", "get_library_hours", "get_event_schedule"}
+# Every other tool blocks on MongoDB or email, so it runs on a bounded pool
+# that keeps the event loop free and caps concurrent load on those servers
+io_pool = ThreadPoolExecutor(max_workers=8, thread_name_prefix="tools-io")
+
+async def run_blocking(fn, *args):
+    """Runs a blocking call on the I/O pool without stalling the event loop."""
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(io_pool, fn, *args)
 
 # 3. Set up the Model
 # Make sure your OPENAI_API_KEY is set in your .env file
-model = ChatOpenAI(model="gpt-4o", temperature=0, streaming=True)
-model_with_tools = model.bind_tools(tools)
+# One keep-alive HTTP/2 client is shared by every request to OpenAI, so
+# concurrent chats multiplex over warm connections instead of new handshakes
+openai_http_client = httpx.AsyncClient(
+    http2=True,
+    limits=httpx.Limits(max_connections=100, max_keepalive_connections=50),
+    timeout=httpx.Timeout(60.0, connect=5.0),
+)
+model = ChatOpenAI(
+    model="gpt-4o",
+    temperature=0,
+    streaming=True,
+    http_async_client=openai_http_client,
+    max_retries=2,
+)
+
+async def close_http_client():
+    """Closes the shared OpenAI HTTP client. Called on app shutdown."""
+    await openai_http_client.aclose()
+
+@functools.cache
+def get_model_with_tools():
+    """Converts the tools to OpenAI schemas and binds them to the model once, on first use."""
+    openai_tools = [convert_to_openai_tool(t) for t in tools]
+    return model.bind(tools=openai_tools, tool_choice="auto")
+
+# Checkpointed threads keep their whole history, but only the most recent
+# part of it is sent to the model, so long conversations stay within its
+# context window and don't resend every old tool result on each turn
+MAX_HISTORY_TOKENS = int(os.getenv("MAX_HISTORY_TOKENS", "24000"))
 
 # 4. Define the Nodes of the Graph
-def call_model(state: AgentState):
+async def call_model(state: AgentState):
     """Invokes the LLM to get a response."""
-    messages = state['messages']
-    response = model_with_tools.invoke(messages)
+    # Keep whole turns from the end: the window starts on a human message, so
+    # a ToolMessage never loses the AI tool call it answers
+    messages = trim_messages(
+        state['messages'],
+        max_tokens=MAX_HISTORY_TOKENS,
+        strategy="last",
+        token_counter=count_tokens_approximately,
+        start_on="human",
+        include_system=True,
+    )
+    response = await get_model_with_tools().ainvoke(messages)
     return {"messages": [response]}
 
-def call_tool(state: AgentState):
-    """Executes a tool call and returns the output."""
+def run_tool(action: dict) -> ToolMessage:
+    """Runs a single tool call and wraps its output in a ToolMessage."""
+    try:
+        tool_output = TOOLS_BY_NAME[action['name']](**action['args'])
+    except Exception as e:
+        tool_output = f"Error: {e}"
+    return ToolMessage(content=str(tool_output), tool_call_id=action['id'])
+
+async def run_tool_async(action: dict) -> ToolMessage:
+    """Runs a tool call inline if it is non-blocking, otherwise on the I/O pool."""
+    if action['name'] in NON_BLOCKING_TOOLS:
+        return run_tool(action)
+    return await run_blocking(run_tool, action)
+
+async def call_tool(state: AgentState):
+    """Executes every tool call from the last message concurrently."""
     last_message = state['messages'][-1]
-    action = last_message.tool_calls[0]
-    tool_output = tool_executor.invoke(action)
-    return {"messages": [ToolMessage(content=str(tool_output), tool_call_id=action['id'])]}
+    tool_messages = await asyncio.gather(
+        *(run_tool_async(action) for action in last_message.tool_calls)
+    )
+    return {"messages": list(tool_messages)}
 
 # 5. Define the Edges of the Graph
 def should_continue(state: AgentState):
@@ -87,5 +156,60 @@ workflow.add_conditional_edges(
 )
 workflow.add_edge("action", "agent")
 
-# This is the object that main.py will import
-app = workflow.compile()
+# Conversation history is checkpointed per thread_id, so each turn only
+# sends the new message and the graph resumes from the saved state
+CHECKPOINT_DB = os.getenv("CHECKPOINT_DB", "checkpoints.db")
+checkpointer = None
+
+async def open_checkpointer():
+    """Opens the SQLite checkpoint store. Called on app startup."""
+    global checkpointer
+    conn = await aiosqlite.connect(CHECKPOINT_DB)
+    saver = AsyncSqliteSaver(conn)
+    try:
+        await saver.setup()
+    except BaseException:
+        # Close the connection so its worker thread can't keep the process alive
+        await conn.close()
+        raise
+    checkpointer = saver
+
+async def close_checkpointer():
+    """Closes the SQLite checkpoint store. Called on app shutdown."""
+    if checkpointer is not None:
+        await checkpointer.conn.close()
+
+@functools.cache
+def get_app():
+    """Compiles the graph once, on first use. This is what main.py runs."""
+    if checkpointer is None:
+        raise RuntimeError("open_checkpointer() must run before the agent app is built.")
+    return workflow.compile(checkpointer=checkpointer)
+
+async def close_pending_tool_calls(config: dict):
+    """
+    Answers any tool calls left unanswered in a thread's saved history, e.g.
+    when the client disconnected mid-run, so OpenAI accepts the next turn.
+    """
+    app = get_app()
+    state = await app.aget_state(config)
+    messages = state.values.get("messages", [])
+    for index in range(len(messages) - 1, -1, -1):
+        if getattr(messages[index], "tool_calls", None):
+            break
+    else:
+        return
+    answered = {m.tool_call_id for m in messages[index + 1:] if isinstance(m, ToolMessage)}
+    missing = [
+        ToolMessage(content="Error: The tool call was interrupted before it finished.", tool_call_id=call['id'])
+        for call in messages[index].tool_calls
+        if call['id'] not in answered
+    ]
+    if missing:
+        await app.aupdate_state(config, {"messages": missing}, as_node="action")
+
+def __getattr__(name):
+    # Keep `from .agent import app` working without compiling at import time
+    if name == "app":
+        return get_app()
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
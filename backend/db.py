@@ -1,37 +1,93 @@
 import os
+import threading
 from pymongo import MongoClient
-from pymongo.errors import ConnectionFailure
+from pymongo.errors import PyMongoError
 
 # Use an environment variable for the URI, with a local default
 MONGO_URI = os.getenv("MONGO_URI", "mongodb://localhost:27017/")
 DB_NAME = "campus_db"
 
+# Connection pool settings, shared by every request handled in this process
+MONGO_MAX_POOL_SIZE = int(os.getenv("MONGO_MAX_POOL_SIZE", "50"))
+MONGO_MIN_POOL_SIZE = int(os.getenv("MONGO_MIN_POOL_SIZE", "5"))
+
+# The pooled client is created lazily on first use and shared process-wide
+mongo_client = None
+mongo_client_lock = threading.Lock()
+# Set once ensure_indexes has succeeded against the server in this process
+indexes_ready = False
+
 def get_db_connection():
     """
-    Establishes and returns a connection to the MongoDB database.
-    Includes error handling for connection failures.
+    Returns the campus database, creating the pooled MongoDB client on
+    first use. With connect=False the client doesn't touch the server until
+    the first operation, so this never blocks; connection problems surface
+    on that operation instead. Returns None if the client can't be created.
+    """
+    global mongo_client
+    if mongo_client is None:
+        with mongo_client_lock:
+            if mongo_client is None:
+                try:
+                    mongo_client = MongoClient(
+                        MONGO_URI,
+                        maxPoolSize=MONGO_MAX_POOL_SIZE,
+                        minPoolSize=MONGO_MIN_POOL_SIZE,
+                        maxIdleTimeMS=30000,
+                        waitQueueTimeoutMS=2000,
+                        serverSelectionTimeoutMS=2000,
+                        retryWrites=True,
+                        connect=False,
+                    )
+                except PyMongoError as e:
+                    print(f"❌ Could not create MongoDB client: {e}")
+                    return None
+    return mongo_client[DB_NAME]
+
+def check_db_connection(db):
+    """
+    Pings the server to verify the connection. Returns True on success.
     """
     try:
-        client = MongoClient(MONGO_URI, serverSelectionTimeoutMS=5000)
-        # The ismaster command is a lightweight way to force a connection check.
-        client.admin.command('ismaster')
+        # The ping command is a lightweight way to force a connection check.
+        db.client.admin.command('ping')
         print("✅ MongoDB connection successful.")
-        return client[DB_NAME]
-    except ConnectionFailure as e:
+        return True
+    except PyMongoError as e:
         print(f"❌ Could not connect to MongoDB: {e}")
-        return None
-
-# Establish the database connection once when the module is loaded
-db_connection = get_db_connection()
+        return False
 
 def get_students_collection():
     """
     A helper function to get the 'students' collection directly.
-    Returns None if the database connection failed.
+    The first successful call in a process also creates the collection's
+    indexes, so writes never run without the unique index on "id". Until
+    that succeeds every call retries it, raising ConnectionFailure while
+    MongoDB is unreachable. Returns None if the database connection failed.
+    """
+    db_connection = get_db_connection()
+    if db_connection is None:
+        return None
+    students_collection = db_connection.students
+    if not indexes_ready:
+        ensure_indexes(students_collection)
+    return students_collection
+
+def ensure_indexes(students_collection):
+    """
+    Creates the indexes backing the student queries, once per process.
+    MongoDB treats re-creating an existing index as a no-op, so racing
+    processes are harmless.
     """
-    if db_connection is not None:
-        return db_connection.students
-    return None
+    global indexes_ready
+    with mongo_client_lock:
+        if indexes_ready:
+            return
+        # Point lookups, updates and deletes all filter on "id"; uniqueness also
+        # makes add_student's duplicate check atomic.
+        students_collection.create_index("id", unique=True)
+        students_collection.create_index("department")
+        indexes_ready = True
 
 # --- Connection Test ---
 # This block will only run when you execute `python backend/db.py` directly.
@@ -39,7 +95,7 @@ def get_students_collection():
 if __name__ == "__main__":
     print("--- Running Database Connection Test ---")
     students_collection = get_students_collection()
-    if students_collection is not None:
+    if students_collection is not None and check_db_connection(students_collection.database):
         print(f"Successfully retrieved '{students_collection.name}' collection from the '{DB_NAME}' database.")
         print("Your db.py file is set up correctly!")
     else:
@@ -1,24 +1,130 @@
 import uvicorn
 import asyncio
-import json
+import uuid
+import orjson
+from typing import Optional
 from fastapi import FastAPI, Request
-from fastapi.responses import StreamingResponse, JSONResponse
+from fastapi.responses import StreamingResponse, ORJSONResponse, Response
+from langchain_core.messages import ToolMessage
+from pymongo.errors import ConnectionFailure
 
+from .db import get_students_collection
 # agent.py se app ko import karein
-from .agent import app as agent_app  
-from .tools import populate_db_with_mock_data, get_total_students, get_students_by_department, list_students, get_student
+from .agent import (
+    get_app as get_agent_app,
+    open_checkpointer,
+    close_checkpointer,
+    close_pending_tool_calls,
+    close_http_client,
+    run_blocking
+)
+from .tools import (
+    CAFETERIA_TIMINGS,
+    LIBRARY_HOURS,
+    EVENT_SCHEDULE,
+    populate_db_with_mock_data,
+    iter_students,
+    get_student_raw,
+    add_student,
+    update_student_raw,
+    delete_student,
+    get_analytics_bundle,
+    get_recent_onboarded_students_raw,
+    get_active_students_last_7_days_raw,
+    send_email
+)
 
 app = FastAPI(
     title="AI Campus Admin Agent API",
     description="A FastAPI server for the AI Campus Admin Agent.",
     version="1.0.0",
+    default_response_class=ORJSONResponse,
 )
 
+# Campus FAQ payloads never change, so encode them once at import
+CAFETERIA_JSON = orjson.dumps({"timings": CAFETERIA_TIMINGS})
+LIBRARY_JSON = orjson.dumps({"hours": LIBRARY_HOURS})
+EVENTS_JSON = orjson.dumps({"events": EVENT_SCHEDULE})
+
+# Student fields a PUT /students/{id} request may change
+STUDENT_UPDATE_FIELDS = ("name", "department", "year", "email")
+
+def db_unavailable():
+    """The response for endpoints that need the database when it is unreachable."""
+    return ORJSONResponse(status_code=503, content={"error": "Error: Database connection failed."})
+
+# Server-sent events must reach the client unbuffered by proxies (e.g. Nginx)
+SSE_HEADERS = {
+    "Cache-Control": "no-cache",
+    "X-Accel-Buffering": "no",
+    "Connection": "keep-alive",
+}
+SSE_HEARTBEAT_SECONDS = 15
+
+async def with_heartbeat(events, interval=SSE_HEARTBEAT_SECONDS):
+    """
+    Re-yields items from an async iterator, yielding None whenever nothing
+    has arrived for `interval` seconds so the caller can send a keepalive.
+    The source iterator is closed when the consumer stops early, e.g. when
+    the client disconnects.
+    """
+    iterator = aiter(events)
+    next_item = asyncio.ensure_future(anext(iterator))
+    try:
+        while True:
+            done, _ = await asyncio.wait({next_item}, timeout=interval)
+            if not done:
+                yield None
+                continue
+            try:
+                item = next_item.result()
+            except StopAsyncIteration:
+                return
+            next_item = asyncio.ensure_future(anext(iterator))
+            yield item
+    finally:
+        next_item.cancel()
+        await asyncio.wait({next_item})
+        await iterator.aclose()
+
+# MongoDB being unreachable is a temporary outage, not a server bug
+@app.exception_handler(ConnectionFailure)
+async def db_connection_failed(request: Request, exc: ConnectionFailure):
+    return db_unavailable()
+
 # Start up event to populate the database
 @app.on_event("startup")
 async def startup_event():
     print("Starting up...")
-    populate_db_with_mock_data()
+    try:
+        # Fetching the collection creates its indexes; if MongoDB is down now,
+        # the first request that reaches it creates them instead
+        populate_db_with_mock_data()
+    except ConnectionFailure as e:
+        # Keep serving; database endpoints answer 503 until MongoDB is reachable
+        print(f"❌ Could not prepare the database: {e}")
+    await open_checkpointer()
+
+@app.on_event("shutdown")
+async def shutdown_event():
+    await close_http_client()
+    await close_checkpointer()
+
+def get_thread_id(data: dict) -> Optional[str]:
+    """
+    Returns the client's conversation id, or starts a new conversation.
+    Returns None if the client sent a thread_id that isn't a non-empty string.
+    """
+    thread_id = data.get("thread_id")
+    if thread_id is None:
+        return uuid.uuid4().hex
+    if not isinstance(thread_id, str) or not thread_id:
+        return None
+    return thread_id
+
+def invalid_thread_id():
+    """The response for chat requests carrying a malformed thread_id."""
+    return ORJSONResponse(status_code=400, content={"error": "thread_id must be a non-empty string."})
 
 # --- Sync Chat Endpoint ---
 @app.post("/chat")
@@ -28,154 +134,164 @@ async def chat_endpoint(request: Request):
         user_message = data.get("message")
         
         if not user_message:
-            return JSONResponse(status_code=400, content={"error": "Message is required."})
+            return ORJSONResponse(status_code=400, content={"error": "Message is required."})
 
-        # LangGraph app ko invoke karein
-        config = {"configurable": {"thread_id": "1"}}  # Simple thread ID for memory
+        # LangGraph app ko invoke karein; the checkpointer restores this thread's history
+        thread_id = get_thread_id(data)
+        if thread_id is None:
+            return invalid_thread_id()
+        config = {"configurable": {"thread_id": thread_id}}
+        await close_pending_tool_calls(config)
         inputs = {"messages": [("human", user_message)]}
-        result = agent_app.invoke(inputs, config=config)
+        result = await get_agent_app().ainvoke(inputs, config=config)
         
         final_message = result['messages'][-1].content
-        return {"response": final_message}
+        return {"response": final_message, "thread_id": thread_id}
 
     except Exception as e:
-        return JSONResponse(status_code=500, content={"error": str(e)})
+        return ORJSONResponse(status_code=500, content={"error": str(e)})
 
 # --- Streaming Chat Endpoint ---
 @app.post("/chat/stream")
 async def chat_stream_endpoint(request: Request):
     data = await request.json()
     user_message = data.get("message")
+    thread_id = get_thread_id(data)
+    if thread_id is None:
+        return invalid_thread_id()
+    config = {"configurable": {"thread_id": thread_id}}
+    await close_pending_tool_calls(config)
 
     async def event_generator():
-        config = {"configurable": {"thread_id": "1"}}
         inputs = {"messages": [("human", user_message)]}
 
-        async for event in agent_app.astream_events(inputs, config=config, version="v1"):
-            kind = event["event"]
-            if kind == "on_chat_model_stream":
-                token = event["data"]["chunk"]
-                if token.content:
-                    yield f"data: {json.dumps({'token': token.content})}\n\n"
-            elif kind == "on_tool_end":
-                output = str(event["data"]["output"])
-                yield f"data: {json.dumps({'tool_output': output})}\n\n"
-            elif kind == "on_end":
-                yield "data: [DONE]\n\n"
+        # "messages" mode yields (message chunk, metadata) pairs directly,
+        # without astream_events' per-token event envelope.
+        events = get_agent_app().astream(inputs, config=config, stream_mode="messages")
+        try:
+            async for event in with_heartbeat(events):
+                if event is None:
+                    yield ": keepalive\n\n"
+                    continue
+                message, metadata = event
+                if isinstance(message, ToolMessage):
+                    yield f"data: {orjson.dumps({'tool_output': str(message.content)}).decode()}\n\n"
+                elif metadata.get("langgraph_node") == "agent" and message.content:
+                    yield f"data: {orjson.dumps({'token': message.content}).decode()}\n\n"
+        except Exception as e:
+            yield f"event: error\ndata: {orjson.dumps({'error': str(e)}).decode()}\n\n"
+        # Always tell the client the stream is complete, even after an error
+        yield f"event: done\ndata: {orjson.dumps({'thread_id': thread_id}).decode()}\n\n"
 
-    return StreamingResponse(event_generator(), media_type="text/event-stream")
+    headers = {**SSE_HEADERS, "X-Thread-Id": thread_id}
+    return StreamingResponse(event_generator(), media_type="text/event-stream", headers=headers)
 
 # --- Analytics Endpoint ---
 @app.get("/analytics")
 def get_analytics():
-    total_students = get_total_students()
-    students_by_dept = get_students_by_department()
-
-    analytics_data = {
-        "total_students": total_students,
-        "students_by_department": students_by_dept,
-    }
-    return JSONResponse(content=analytics_data)
+    analytics_data = get_analytics_bundle()
+    if analytics_data is None:
+        return db_unavailable()
+    return ORJSONResponse(content=analytics_data)
 
 # --- Students CRUD Endpoints (Optional but useful for testing) ---
 @app.get("/students")
 def get_all_students():
-    return JSONResponse(content=json.loads(list_students()))
+    if get_students_collection() is None:
+        return db_unavailable()
+    return StreamingResponse(iter_students(), media_type="application/json")
 
 @app.get("/students/{student_id}")
 def get_student_by_id(student_id: str):
-    student = get_student(student_id)
-    if student.startswith("Error"):
-        return JSONResponse(status_code=404, content={"error": student})
-    return JSONResponse(content=json.loads(student))
+    if get_students_collection() is None:
+        return db_unavailable()
+    student = get_student_raw(student_id)
+    if student is None:
+        return ORJSONResponse(status_code=404, content={"error": f"Error: No student found with ID {student_id}."})
+    return ORJSONResponse(content=student)
 
 # --- Additional Campus Information Endpoints ---
 @app.get("/campus/cafeteria")
 def get_cafeteria_info():
-    from .tools import get_cafeteria_timings
-    return JSONResponse(content={"timings": get_cafeteria_timings()})
+    return Response(content=CAFETERIA_JSON, media_type="application/json")
 
 @app.get("/campus/library")
 def get_library_info():
-    from .tools import get_library_hours
-    return JSONResponse(content={"hours": get_library_hours()})
+    return Response(content=LIBRARY_JSON, media_type="application/json")
 
 @app.get("/campus/events")
 def get_events():
-    from .tools import get_event_schedule
-    return JSONResponse(content={"events": get_event_schedule()})
+    return Response(content=EVENTS_JSON, media_type="application/json")
 
 # --- Student Management Endpoints ---
 @app.post("/students")
 async def add_new_student(request: Request):
     try:
         data = await request.json()
-        from .tools import add_student
         result = add_student(
+            data.get("id"),
             data.get("name"), 
             data.get("department"), 
-            data.get("year"), 
             data.get("email")
         )
         if result.startswith("Error"):
-            return JSONResponse(status_code=400, content={"error": result})
-        return JSONResponse(status_code=201, content=json.loads(result))
+            return ORJSONResponse(status_code=400, content={"error": result})
+        return ORJSONResponse(status_code=201, content={"message": result})
+    except ConnectionFailure:
+        return db_unavailable()
     except Exception as e:
-        return JSONResponse(status_code=500, content={"error": str(e)})
+        return ORJSONResponse(status_code=500, content={"error": str(e)})
 
 @app.put("/students/{student_id}")
 async def update_student_info(student_id: str, request: Request):
     try:
         data = await request.json()
-        from .tools import update_student
-        result = update_student(
-            student_id,
-            data.get("name"), 
-            data.get("department"), 
-            data.get("year"), 
-            data.get("email")
-        )
-        if result.startswith("Error"):
-            return JSONResponse(status_code=404, content={"error": result})
-        return JSONResponse(content=json.loads(result))
+        updates = {field: data[field] for field in STUDENT_UPDATE_FIELDS if field in data}
+        if not updates:
+            return ORJSONResponse(status_code=400, content={"error": "No fields to update."})
+        if get_students_collection() is None:
+            return db_unavailable()
+        student = update_student_raw(student_id, updates)
+        if student is None:
+            return ORJSONResponse(status_code=404, content={"error": f"Error: No student found with ID {student_id}."})
+        return ORJSONResponse(content=student)
+    except ConnectionFailure:
+        return db_unavailable()
     except Exception as e:
-        return JSONResponse(status_code=500, content={"error": str(e)})
+        return ORJSONResponse(status_code=500, content={"error": str(e)})
 
 @app.delete("/students/{student_id}")
 def delete_student_record(student_id: str):
-    from .tools import delete_student
     result = delete_student(student_id)
     if result.startswith("Error"):
-        return JSONResponse(status_code=404, content={"error": result})
-    return JSONResponse(content={"message": result})
+        return ORJSONResponse(status_code=404, content={"error": result})
+    return ORJSONResponse(content={"message": result})
 
 # --- Advanced Analytics Endpoints ---
 @app.get("/analytics/recent-onboarded")
 def get_recent_onboarded():
-    from .tools import get_recent_onboarded_students
-    return JSONResponse(content={"recent_students": json.loads(get_recent_onboarded_students())})
+    if get_students_collection() is None:
+        return db_unavailable()
+    return ORJSONResponse(content={"recent_students": get_recent_onboarded_students_raw()})
 
 @app.get("/analytics/active-students")
 def get_active_students():
-    from .tools import get_active_students_last_7_days
-    return JSONResponse(content={"active_students": json.loads(get_active_students_last_7_days())})
+    if get_students_collection() is None:
+        return db_unavailable()
+    return ORJSONResponse(content={"active_students": get_active_students_last_7_days_raw()})
 
 # --- Communication Endpoints ---
 @app.post("/communication/email")
 async def send_email_to_student(request: Request):
     try:
         data = await request.json()
-        from .tools import send_email
-        result = send_email(
-            data.get("student_id"),
-            data.get("subject"),
-            data.get("body")
-        )
+        message = f"{data.get('subject')}\n\n{data.get('body')}"
+        result = await run_blocking(send_email, data.get("student_id"), message)
         if result.startswith("Error"):
-            return JSONResponse(status_code=400, content={"error": result})
-        return JSONResponse(content={"message": result})
+            return ORJSONResponse(status_code=400, content={"error": result})
+        return ORJSONResponse(content={"message": result})
     except Exception as e:
-        return JSONResponse(status_code=500, content={"error": str(e)})
+        return ORJSONResponse(status_code=500, content={"error": str(e)})
 
 if __name__ == "__main__":
     uvicorn.run("backend.main:app", host="0.0.0.0", port=8000, reload=True)
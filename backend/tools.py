@@ -1,29 +1,63 @@
-import json
 import random
-from typing import Optional, Dict, Any
+import functools
+import threading
+import orjson
+from typing import Dict, Any
+
+from cachetools import TTLCache, cached
+from cachetools.keys import hashkey
+from pymongo import InsertOne, ReturnDocument
+from pymongo.errors import BulkWriteError, DuplicateKeyError
 
 # Assuming get_students_collection is correctly defined in your db.py
 from .db import get_students_collection
 
-# Database connection
-students_collection = get_students_collection()
+# Static campus FAQ answers
+CAFETERIA_TIMINGS = "The cafeteria is open from 8:00 AM to 10:00 PM."
+LIBRARY_HOURS = "The library is open from 9:00 AM to 9:00 PM on weekdays and 10:00 AM to 6:00 PM on weekends."
+EVENT_SCHEDULE = "Upcoming events: AI Hackathon on 25th Oct, Annual Sports Day on 15th Nov."
+
+# Fields returned to the model by list_students, the largest page it may
+# ask for, and a cap on the size of that output so a large collection
+# can't flood the model's context
+STUDENT_LIST_PROJECTION = {"_id": 0, "id": 1, "name": 1, "department": 1, "email": 1}
+LIST_STUDENTS_MAX_LIMIT = 200
+LIST_STUDENTS_MAX_BYTES = 16_000
+# Room reserved within that cap for the page's own keys around the student
+# array: {"students":[...],"truncated":true,"next_skip":N} is under 64 bytes
+LIST_STUDENTS_ENVELOPE_BYTES = 64
+
+# Short-lived cache for read-only tool results. The model often repeats the
+# same lookup within a turn; every write clears it.
+tool_cache = TTLCache(maxsize=256, ttl=30)
+tool_cache_lock = threading.Lock()
+
+def cached_tool(fn):
+    """Caches a read-only tool's result, keyed on the tool name and arguments."""
+    return cached(tool_cache, key=functools.partial(hashkey, fn.__name__), lock=tool_cache_lock)(fn)
+
+def clear_tool_cache():
+    with tool_cache_lock:
+        tool_cache.clear()
 
 # --- Mock Data Population ---
 
 def populate_db_with_mock_data():
     """
-    Populates the students collection with mock data for testing.
-    This function is called at application startup.
+    Seeds the students collection with mock data for testing.
+    This function is called at application startup and is idempotent:
+    an already-populated collection is left untouched, so reloads and
+    multiple workers don't wipe or duplicate each other's data.
     """
+    students_collection = get_students_collection()
     if students_collection is None:
         print("Could not populate mock data: database connection failed.")
         return
 
-    # Clear existing data
-    students_collection.delete_many({})
-    print("Clearing existing mock data.")
+    if students_collection.count_documents({}, limit=1):
+        print("Mock data already present, skipping seed.")
+        return
 
-    # Generate and insert new mock data
     mock_students = [
         {"id": "23-1001", "name": "Ayesha Khan", "department": "Computer Science", "email": "ayesha@saylani.edu"},
         {"id": "23-1002", "name": "Usman Ali", "department": "Software Engineering", "email": "usman@saylani.edu"},
@@ -31,20 +65,98 @@ def populate_db_with_mock_data():
         {"id": "23-1004", "name": "Bilal Ahmed", "department": "Computer Science", "email": "bilal@saylani.edu"},
         {"id": "23-1005", "name": "Sana Ejaz", "department": "Software Engineering", "email": "sana@saylani.edu"}
     ]
-    students_collection.insert_many(mock_students)
+    try:
+        # Unordered, so a duplicate key from another worker doesn't abort the rest.
+        students_collection.bulk_write([InsertOne(s) for s in mock_students], ordered=False)
+    except BulkWriteError:
+        print("Mock data partially seeded by another worker.")
+        return
+    finally:
+        clear_tool_cache()
     print("Populated database with mock data.")
 
 # --- Student Management Tools (CRUD) ---
 
-def list_students():
+def list_students_raw(limit: int = 50, skip: int = 0):
     """
-    Lists all students in the database.
+    Returns one page of students, ordered by ID, with the listed fields only.
+    Callers must pass a `limit` of at least 1, since 0 means "no limit" to
+    MongoDB, and a non-negative `skip`; list_students clamps both.
     """
-    if students_collection is None:
+    students_collection = get_students_collection()
+    cursor = (
+        students_collection.find({}, STUDENT_LIST_PROJECTION)
+        .sort("id")
+        .skip(skip)
+        .limit(limit)
+        .batch_size(limit)
+    )
+    return list(cursor)
+
+@cached_tool
+def list_students(limit: int = 50, skip: int = 0):
+    """
+    Lists students in the database, ordered by ID, one page at a time.
+    Returns {"students": [...]}, plus "next_skip" when more students may
+    follow; pass it as `skip` to fetch the next page.
+    
+    Args:
+        limit (int): The maximum number of students to return (at most 200).
+        skip (int): The number of students to skip, for fetching later pages.
+    """
+    if get_students_collection() is None:
         return "Error: Database connection failed."
-    students = list(students_collection.find({}, {"_id": 0}))
-    return json.dumps(students, indent=2)
+    limit = max(1, min(limit, LIST_STUDENTS_MAX_LIMIT))
+    skip = max(0, skip)
+    students = list_students_raw(limit, skip)
+    # Stop before the encoded page would exceed the byte budget
+    chunks, size = [], LIST_STUDENTS_ENVELOPE_BYTES
+    for student in students:
+        chunk = orjson.dumps(student)
+        size += len(chunk) + 1
+        if size > LIST_STUDENTS_MAX_BYTES:
+            break
+        chunks.append(chunk)
+    page = {"students": orjson.Fragment(b"[" + b",".join(chunks) + b"]")}
+    if len(chunks) < len(students):
+        # The byte budget cut this page short; resume right after the last row sent
+        page["truncated"] = True
+        page["next_skip"] = skip + len(chunks)
+    elif len(students) == limit:
+        page["next_skip"] = skip + limit
+    return orjson.dumps(page).decode()
+
+def iter_students():
+    """
+    Returns an iterator over all students as a JSON array, encoding one
+    document at a time so the full collection is never held in memory.
+    The first batch is fetched up front, so connection errors raise here
+    rather than after a streaming response has started.
+    """
+    students_collection = get_students_collection()
+    cursor = students_collection.find({}, {"_id": 0}).batch_size(500)
+    first = next(cursor, None)
+    return encode_students(first, cursor)
+
+def encode_students(first, cursor):
+    """
+    Yields `first` and then the rest of `cursor` as chunks of a JSON array.
+    """
+    yield b"["
+    if first is not None:
+        yield orjson.dumps(first)
+        for student in cursor:
+            yield b"," + orjson.dumps(student)
+    yield b"]"
 
+def get_student_raw(id: str):
+    """
+    Returns a student's record by ID, or None if there is no such student.
+    """
+    students_collection = get_students_collection()
+    return students_collection.find_one({"id": id}, {"_id": 0})
+
+@cached_tool
 def get_student(id: str):
     """
     Retrieves a single student's record by their ID.
@@ -52,11 +164,11 @@ def get_student(id: str):
     Args:
         id (str): The ID of the student to retrieve.
     """
-    if students_collection is None:
+    if get_students_collection() is None:
         return "Error: Database connection failed."
-    student = students_collection.find_one({"id": id}, {"_id": 0})
+    student = get_student_raw(id)
     if student:
-        return json.dumps(student, indent=2)
+        return orjson.dumps(student).decode()
     return f"Error: No student found with ID {id}."
 
 def add_student(id: str, name: str, department: str, email: str):
@@ -69,39 +181,56 @@ def add_student(id: str, name: str, department: str, email: str):
         department (str): The new student's department.
         email (str): The new student's email.
     """
+    students_collection = get_students_collection()
     if students_collection is None:
         return "Error: Database connection failed."
-    if students_collection.find_one({"id": id}):
-        return f"Error: Student with ID {id} already exists."
-    
     new_student = {
         "id": id,
         "name": name,
         "department": department,
         "email": email
     }
-    students_collection.insert_one(new_student)
+    # get_students_collection only hands out the collection once the unique
+    # index on "id" exists, so a duplicate ID always fails here
+    try:
+        students_collection.insert_one(new_student)
+    except DuplicateKeyError:
+        return f"Error: Student with ID {id} already exists."
+    clear_tool_cache()
     return f"Success: Student {name} with ID {id} has been added."
 
+def update_student_raw(id: str, updates: Dict[str, Any]):
+    """
+    Applies `updates` to a student record and returns the updated document,
+    or None if no student has that ID. Mutates and reads in one round-trip.
+    """
+    students_collection = get_students_collection()
+    student = students_collection.find_one_and_update(
+        {"id": id},
+        {"$set": updates},
+        projection={"_id": 0},
+        return_document=ReturnDocument.AFTER
+    )
+    if student is not None:
+        clear_tool_cache()
+    return student
+
 def update_student(id: str, field: str, new_value: str):
     """
-    Updates a specific field for a student record.
+    Updates a specific field for a student record and returns the updated record.
     
     Args:
         id (str): The ID of the student to update.
         field (str): The field to update (e.g., 'name', 'department', 'email').
         new_value (str): The new value for the field.
     """
-    if students_collection is None:
+    if get_students_collection() is None:
         return "Error: Database connection failed."
     
-    result = students_collection.update_one(
-        {"id": id},
-        {"$set": {field: new_value}}
-    )
-    if result.matched_count == 0:
+    student = update_student_raw(id, {field: new_value})
+    if student is None:
         return f"Error: No student found with ID {id}."
-    return f"Success: Student with ID {id} updated successfully."
+    return orjson.dumps(student).decode()
 
 def delete_student(id: str):
     """
@@ -110,40 +239,86 @@ def delete_student(id: str):
     Args:
         id (str): The ID of the student to delete.
     """
+    students_collection = get_students_collection()
     if students_collection is None:
         return "Error: Database connection failed."
     
     result = students_collection.delete_one({"id": id})
     if result.deleted_count == 0:
         return f"Error: No student found with ID {id}."
+    clear_tool_cache()
     return f"Success: Student with ID {id} has been deleted."
 
 # --- Campus Analytics Tools ---
 
+@cached_tool
 def get_total_students():
     """
     Returns the total count of students in the database.
     """
+    students_collection = get_students_collection()
     if students_collection is None:
         return "Error: Database connection failed."
     count = students_collection.count_documents({})
     return str(count)
 
+def get_students_by_department_raw():
+    """
+    Returns a dict mapping each department to its number of students.
+    """
+    students_collection = get_students_collection()
+    pipeline = [
+        {"$group": {"_id": "$department", "count": {"$sum": 1}}}
+    ]
+    results = students_collection.aggregate(pipeline)
+    return {item['_id']: item['count'] for item in results}
+
+@cached_tool
 def get_students_by_department():
     """
     Returns a count of students grouped by their department.
     """
-    if students_collection is None:
+    if get_students_collection() is None:
         return "Error: Database connection failed."
+    return orjson.dumps(get_students_by_department_raw()).decode()
+
+def get_analytics_bundle():
+    """
+    Returns the total student count and per-department counts, computed
+    in a single aggregation round-trip. Returns None if the database
+    connection failed.
+    """
+    students_collection = get_students_collection()
+    if students_collection is None:
+        return None
     
     pipeline = [
-        {"$group": {"_id": "$department", "count": {"$sum": 1}}}
+        {"$facet": {
+            "total": [{"$count": "n"}],
+            "by_department": [{"$group": {"_id": "$department", "count": {"$sum": 1}}}]
+        }}
     ]
-    results = list(students_collection.aggregate(pipeline))
-    dept_counts = {item['_id']: item['count'] for item in results}
-    return json.dumps(dept_counts, indent=2)
+    result = next(students_collection.aggregate(pipeline))
+    return {
+        "total_students": result["total"][0]["n"] if result["total"] else 0,
+        "students_by_department": {item['_id']: item['count'] for item in result["by_department"]}
+    }
 
-def get_recent_onboarded_students(limit: Optional[int] = 5):
+def get_recent_onboarded_students_raw(limit: int = 5):
+    """
+    Returns a list of up to `limit` recently onboarded students.
+    """
+    students_collection = get_students_collection()
+    # In a real app, you would sort by an indexed 'created_at' timestamp:
+    # [{"$sort": {"created_at": -1}}, {"$limit": limit}, ...]
+    # Here, we let the database pick a random subset of students.
+    pipeline = [
+        {"$sample": {"size": limit}},
+        {"$project": {"_id": 0}}
+    ]
+    return list(students_collection.aggregate(pipeline))
+
+def get_recent_onboarded_students(limit: int = 5):
     """
     Returns a list of the most recently onboarded students.
     (This is a mock implementation since we don't have a date field.)
@@ -151,27 +326,27 @@ def get_recent_onboarded_students(limit: Optional[int] = 5):
     Args:
         limit (int): The number of recent students to return.
     """
-    if students_collection is None:
+    if get_students_collection() is None:
         return "Error: Database connection failed."
-    
-    # In a real app, you would sort by a 'created_at' timestamp.
-    # Here, we'll just return a random subset of students.
-    all_students = list(students_collection.find({}, {"_id": 0}))
-    random.shuffle(all_students)
-    recent = all_students[:limit]
-    return json.dumps(recent, indent=2)
+    return orjson.dumps(get_recent_onboarded_students_raw(limit)).decode()
+
+def get_active_students_last_7_days_raw():
+    """
+    Returns the number of students active in the last 7 days as an int.
+    """
+    students_collection = get_students_collection()
+    total_students = students_collection.count_documents({})
+    # Return a random number to simulate activity
+    return random.randint(int(total_students * 0.5), total_students)
 
 def get_active_students_last_7_days():
     """
     Returns the number of active students in the last 7 days.
     (This is a mock implementation as there are no activity logs.)
     """
-    if students_collection is None:
+    if get_students_collection() is None:
         return "Error: Database connection failed."
-    total_students = students_collection.count_documents({})
-    # Return a random number to simulate activity
-    active_count = random.randint(int(total_students * 0.5), total_students)
-    return str(active_count)
+    return str(get_active_students_last_7_days_raw())
 
 # --- Campus FAQ Tools ---
 
@@ -179,19 +354,19 @@ def get_cafeteria_timings():
     """
     Provides the timings for the campus cafeteria.
     """
-    return "The cafeteria is open from 8:00 AM to 10:00 PM."
+    return CAFETERIA_TIMINGS
 
 def get_library_hours():
     """
     Provides the operating hours for the campus library.
     """
-    return "The library is open from 9:00 AM to 9:00 PM on weekdays and 10:00 AM to 6:00 PM on weekends."
+    return LIBRARY_HOURS
 
 def get_event_schedule():
     """
     Provides the schedule for upcoming campus events.
     """
-    return "Upcoming events: AI Hackathon on 25th Oct, Annual Sports Day on 15th Nov."
+    return EVENT_SCHEDULE
 
 # --- Notification Tool ---
 